@@ -1,27 +1,173 @@
 #!/usr/bin/env python3
-import pandas as pd
 import json
-import glob
 import os
 import argparse
 import sys
 import re
-from shutil import which
+import fnmatch
 from socket import gethostname
-import subprocess
 import logging
-from urllib.error import HTTPError
-from slack import WebClient
-from slack.errors import SlackApiError
+import mmap
+import fcntl
+import stat
+import threading
+import time
+import hashlib
+# slack_sdk is the maintained successor to slackclient's `slack` package
+try:
+    from slack_sdk import WebClient
+    from slack_sdk.errors import SlackApiError
+except ImportError:
+    from slack import WebClient
+    from slack.errors import SlackApiError
 from random import choice
-import numpy as np
-import skimage
-import mrcfile
-import starfile
-import matplotlib.pyplot as plt
-
-# remove annoying pandas error message
-pd.options.mode.chained_assignment = None
+from concurrent.futures import ThreadPoolExecutor
+
+# orjson is much faster than the stdlib encoder but isn't required
+try:
+    import orjson
+    json_loads, json_dumps = orjson.loads, orjson.dumps
+except ImportError:
+    json_loads, json_dumps = json.loads, json.dumps
+
+def load_processing_modules():
+    # the scientific stack takes seconds to import and the database
+    # commands don't need any of it, so only pull it in once we know
+    # we're going to process jobs
+    global pd, np, mrcfile, starfile, Figure, downscale_local_mean
+    import pandas as pd
+    import numpy as np
+    import mrcfile
+    from skimage.transform import downscale_local_mean
+    import starfile
+    # figures are built directly rather than through pyplot, so no backend
+    # gets picked and nothing is kept in pyplot's list of open figures.
+    # savefig uses Agg for PNGs on its own.
+    from matplotlib.figure import Figure
+
+    # remove annoying pandas error message
+    pd.options.mode.chained_assignment = None
+
+# a successful Slack auth_test is remembered here so that cron runs don't
+# make a round trip to Slack every time just to check the token
+AUTH_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'exawatcher', 'auth_ok')
+AUTH_CACHE_TTL = 24 * 3600
+# plots are flat colours and lines, so light compression gets them
+# nearly as small as the default for a fraction of the encoding time
+PNG_OPTIONS = {'compress_level': 1}
+
+# if Slack rejects the token after all, forget that it was ever good
+AUTH_ERRORS = ['invalid_auth', 'not_authed', 'token_revoked', 'token_expired', 'account_inactive']
+
+# how often --daemon rescans even if it hasn't seen a job finish
+DAEMON_RESCAN = 600
+
+# statuses RELION jobs don't leave unless files in the job directory change
+TERMINAL_STATUSES = ['Finished', 'Failed', 'User Abort']
+
+JOB_RE = re.compile('job([0-9]{3,})$')
+CLASS_MAP_RE = re.compile(r'run_it([0-9]{3,})_class[0-9]{3}\.mrc$')
+CLASS_RE = re.compile('(class[0-9]{3})')
+NUM_RE = re.compile('[0-9.]+')
+PARTICLES_RE = re.compile('[0-9]+ particles')
+
+# status changes are posted together, this many jobs to a message
+STATUS_LINES_PER_MESSAGE = 40
+
+GREETINGS = [
+    'How are you?',
+    'Hope you\'re well.',
+    "How's it going?",
+    "How's research?",
+    "When are you going to graduate? Haha, anyway.",
+    "Lookin' good!",
+    "Are you drinking water?",
+    "Have a snack after this!"
+]
+
+def atomic_write(path, contents):
+    # write beside the target and rename over it, so a crash mid-write
+    # never leaves a truncated file behind. Follow symlinks first or the
+    # rename would swap the link for a plain file.
+    path = os.path.realpath(path)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb' if isinstance(contents, bytes) else 'w') as f:
+        # the new file gets the umask's permissions, but the db holds the
+        # Slack token and is meant to stay chmod 600, so carry the old
+        # file's mode and owner over before anything is written to it
+        try:
+            old_stat = os.stat(path)
+        except FileNotFoundError:
+            old_stat = None
+        if old_stat is not None:
+            os.fchmod(f.fileno(), stat.S_IMODE(old_stat.st_mode))
+            try:
+                os.fchown(f.fileno(), old_stat.st_uid, old_stat.st_gid)
+            except PermissionError:
+                pass
+        f.write(contents)
+    os.replace(tmp_path, path)
+
+def list_dir(path, pattern):
+    # a single directory read, filtered by name, sorted so that output
+    # is in the same order every time
+    with os.scandir(path) as entries:
+        return sorted(x.path for x in entries if fnmatch.fnmatchcase(x.name, pattern))
+
+def mtime_settled(mtime_ns):
+    # with coarse (e.g. NFS) timestamps, a file created just after we look
+    # can leave a directory's mtime unchanged, so only trust an mtime as a
+    # sign that nothing changed once it's a couple of seconds old
+    return time.time_ns() - mtime_ns > 2 * 10**9
+
+def drop_from_page_cache(path):
+    # maps are read once and never again, so tell the kernel it can have
+    # the memory back rather than push out things other users need
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+def last_line_containing(path, text):
+    # the lines we want are near the end of RELION's logs, which can be
+    # large, so search backwards through a memory map rather than reading
+    # and decoding every line from the top
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as log:
+            found = log.rfind(text.encode())
+            if found == -1:
+                return None
+            line_start = log.rfind(b'\n', 0, found) + 1
+            line_end = log.find(b'\n', found)
+            if line_end == -1:
+                line_end = len(log)
+            return log[line_start:line_end].decode(errors = 'replace')
+
+def project_volume(vol, slab_bytes = 1 << 20):
+    # Sum a volume along all three axes in a single pass. np.sum once per
+    # axis streams the whole map through memory three times; going a slab
+    # of planes at a time lets all three sums reuse the slab while it's
+    # still in cache.
+    nz, ny, nx = vol.shape
+    slab_size = max(1, slab_bytes // (ny * nx * vol.dtype.itemsize))
+
+    # float32 is plenty for a picture and keeps float64 or integer maps
+    # from being widened to 8 bytes per voxel along the way
+    x_proj = np.zeros((ny, nx), dtype = np.float32)
+    y_proj = np.empty((nz, nx), dtype = np.float32)
+    z_proj = np.empty((nz, ny), dtype = np.float32)
+    for start in range(0, nz, slab_size):
+        slab = vol[start:start + slab_size]
+        x_proj += slab.sum(axis = 0, dtype = np.float32)
+        y_proj[start:start + slab_size] = slab.sum(axis = 1, dtype = np.float32)
+        z_proj[start:start + slab_size] = slab.sum(axis = 2, dtype = np.float32)
+
+    return x_proj, y_proj, z_proj
 
 class Settings(object):
     def __init__(self, settings_dict:dict = None):
@@ -84,9 +230,12 @@ class Database(object):
         self.db_dir = os.path.split(db_path)[0]
 
         self.lock_file = os.path.join(self.db_dir, '.dblock')
+        # what's on disk right now, so commit_change can tell if it's stale
+        self._committed = None
         try:
-            with open(self.db_path, 'r') as f:
-                db_json = json.load(f)
+            with open(self.db_path, 'rb') as f:
+                self._committed = f.read()
+                db_json = json_loads(self._committed)
                 if 'version' not in db_json:
                     projects = [x for x in db_json.keys() if x not in ['slack_key', 'slack_dm', 'settings']]
                     db_json['projects'] = {x: db_json[x] for x in projects}
@@ -106,7 +255,6 @@ class Database(object):
     @slack_key.setter
     def slack_key(self, new_key):
         self.db['slack_key'] = new_key
-        self.commit_change()
 
     @property
     def slack_dm(self):
@@ -115,31 +263,43 @@ class Database(object):
     @slack_dm.setter
     def slack_dm(self, new_dm_id):
         self.db['slack_dm'] = new_dm_id
-        self.commit_change()
 
     @property
     def current_projects(self):
         return self.db['projects'].keys()
 
     def check_lock(self):
-        if os.path.exists(self.lock_file):
-            logging.info('Lock file exists. Exiting.')
+        # the kernel lets go of a flock when we exit, however we exit, so a
+        # crash can't leave the lock held and the lock file itself means nothing
+        self._lock_fd = os.open(self.lock_file, os.O_CREAT | os.O_RDWR, 0o644)
+        try:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.info('Another exawatcher is processing. Exiting.')
             sys.exit(1)
-        else:
-            open(self.lock_file, 'a').close()
 
     def clear_lock(self):
-        if os.path.exists(self.lock_file):
-            os.remove(self.lock_file)
+        # kept so old cron lines with --clear-lock still work. Deleting the
+        # file while someone holds the lock would let a second process in.
+        logging.info('The lock is released when exawatcher exits, nothing to clear.')
 
     def commit_change(self):
         self.db['settings'] = self.settings.settings
-        with open(self.db_path, 'w') as f:
-            json.dump(self.db, f)
+        db_bytes = json_dumps(self.db)
+        if isinstance(db_bytes, str):
+            db_bytes = db_bytes.encode()
+
+        # most runs only process jobs and never touch the database, so
+        # don't rewrite it unless something actually changed
+        if db_bytes == self._committed:
+            return
+
+        atomic_write(self.db_path, db_bytes)
+        self._committed = db_bytes
 
     def close_db(self):
         self.commit_change()
-        os.remove(self.lock_file)
+        os.close(self._lock_fd)
 
     def new_project(self, project_dir):
         project_dir = os.path.expanduser(project_dir)
@@ -149,7 +309,6 @@ class Database(object):
             sys.exit(1)
         project_name = os.path.split(project_dir)[1]
         self.db['projects'][project_name] = project_dir
-        self.commit_change()
 
     def remove_project(self, project_name):
         try:
@@ -164,42 +323,135 @@ class Project(object):
         self.project_dir = project_dir
         self.slack_info = slack_info
         self.settings = settings
+        # terminal jobs we can skip without even reading last_status.txt
+        self.status_cache_path = os.path.join(project_dir, '.exawatcher', 'status_cache.json')
+        self.status_cache = {}
+        self.cached_jobs = set()
 
     def __repr__(self):
         return f'Project {self.project_name}'
 
-    def scan_for_jobs(self):
-        self.usable_jobs = {}
-        all_jobs = glob.glob(os.path.join(self.project_dir, '*', 'job*'))
-        for job in all_jobs:
-            try:
-              job_num = re.search('job([0-9]{3})', job).group(1)
-            except AttributeError:
-              continue
+    def load_status_cache(self):
+        try:
+            with open(self.status_cache_path, 'rb') as f:
+                return json_loads(f.read())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def save_status_cache(self):
+        status_cache = {x: self.status_cache[x] for x in self.cached_jobs}
+        for job_num, job in self.usable_jobs.items():
+            # a job whose status hasn't been saved still needs processing
+            if job.status not in TERMINAL_STATUSES or job.new_job_mtime is not None:
+                continue
+            job_mtime = os.stat(job.path).st_mtime_ns
+            if mtime_settled(job_mtime):
+                status_cache[job_num] = [job.status, job_mtime, os.stat(job.status_path).st_mtime_ns]
+
+        if status_cache != self.status_cache:
+            os.makedirs(os.path.dirname(self.status_cache_path), exist_ok = True)
+            atomic_write(self.status_cache_path, json_dumps(status_cache))
+
+    def job_unchanged(self, job_num, job_path):
+        # a finished, failed or aborted job only needs looking at again if
+        # RELION adds or removes files in it, or someone deletes its
+        # last_status.txt to have it processed again
+        try:
+            _, job_mtime, status_mtime = self.status_cache[job_num]
+            return os.stat(job_path).st_mtime_ns == job_mtime and \
+                os.stat(os.path.join(job_path, '.exawatcher', 'last_status.txt')).st_mtime_ns == status_mtime
+        except (KeyError, OSError):
+            return False
+
+    def scan_for_jobs(self, force = False):
+        self.status_cache = {} if force else self.load_status_cache()
+        self.cached_jobs = set()
+        to_load = []
+        available_jobs = self.settings.available_jobs
+        # RELION keeps each job type in a top-level directory named after it,
+        # so only those directories need listing. Things like Movies/ with
+        # thousands of files never get read.
+        with os.scandir(self.project_dir) as type_dirs:
+            for type_dir in type_dirs:
+                job_class = available_jobs.get(type_dir.name)
+                if job_class is None or not type_dir.is_dir():
+                    # not a job type we can process yet
+                    continue
 
-            job_type = [x for x in self.settings.available_jobs.keys() if x in job]
-            try:
-                job_type = job_type[0]
-            except IndexError:
-                # not a job type we can process yet
-                job_type = False
-
-            if job_type:
-                self.usable_jobs[job_num] = self.settings.available_jobs[job_type](
-                    job,
-                    self.project_name,
-                    job_num,
-                    self.slack_info,
-                    self.settings
-                )
+                with os.scandir(type_dir.path) as jobs:
+                    for job in jobs:
+                        job_num = JOB_RE.match(job.name)
+                        if not job_num or not job.is_dir():
+                            continue
+
+                        job_num = job_num.group(1)
+                        if self.job_unchanged(job_num, job.path):
+                            self.cached_jobs.add(job_num)
+                        else:
+                            to_load.append((job_num, job.path, job_class))
+
+        def load_job(job_info):
+            job_num, job, job_class = job_info
+            return job_num, job_class(
+                job,
+                self.project_name,
+                job_num,
+                self.slack_info,
+                self.settings
+            )
+
+        # every job reads its own last_status.txt, which is slow
+        # on network filesystems, so overlap that I/O across jobs
+        with ThreadPoolExecutor(max_workers = 16) as executor:
+            self.usable_jobs = dict(executor.map(load_job, to_load))
 
     def process_jobs(self, force = False):
-        for job in self.usable_jobs.values():
-            if job.status != job.old_status or force:
-                if job.status == 'Finished':
-                    job.finished_process()
-                
-                job.announce()
+        # jobs with nothing to upload get rolled into one message, so that a
+        # burst of status changes doesn't turn into a burst of Slack posts
+        status_only = []
+        # matplotlib isn't thread safe, so jobs are processed one at a time.
+        # Posting and uploading is just waiting on Slack though, so it
+        # happens in the background while the next job is processed.
+        with ThreadPoolExecutor(max_workers = 4) as executor:
+            announcements = []
+            try:
+                for job in self.usable_jobs.values():
+                    if job.status == job.old_status and not force:
+                        # nothing to say, but remember the new mtime
+                        job.save_status()
+                        continue
+
+                    if job.status == 'Finished':
+                        job.finished_process()
+
+                    if job.files:
+                        announcements.append((job, executor.submit(job.announce)))
+                    else:
+                        status_only.append(job)
+
+                if len(status_only) == 1:
+                    status_only[0].announce()
+                else:
+                    # keep each post well inside Slack's message length limit
+                    for start in range(0, len(status_only), STATUS_LINES_PER_MESSAGE):
+                        self.slack_info['client'].chat_postMessage(
+                            channel = self.slack_info['dm'],
+                            text = f'Hi! {choice(GREETINGS)}\n' + '\n'.join(
+                                job.message for job in status_only[start:start + STATUS_LINES_PER_MESSAGE]
+                            )
+                        )
+                for job in status_only:
+                    job.save_status()
+            finally:
+                # only jobs that have been announced are marked as done, so
+                # anything that fails here is tried again next time
+                for job, announcement in announcements:
+                    if announcement.exception() is None:
+                        job.save_status()
+
+            # raise any errors from the background posts
+            for job, announcement in announcements:
+                announcement.result()
 
 
 class RelionJob(object):
@@ -216,23 +468,29 @@ class RelionJob(object):
         self.settings = settings
         self.files = []
 
-        if not os.path.exists(self.exapath):
-            os.makedirs(self.exapath)
-            with open(self.status_path, 'a') as f:
-                f.write('Pending')
-            self.old_status = 'Pending'
-
+        # last_status.txt holds the status and, on a second line, the job
+        # directory's mtime when that status was worked out
+        self.old_status = 'Pending'
+        old_job_mtime = None
+        try:
+            with open(self.status_path, 'r') as f:
+                self.old_status = f.readline().rstrip()
+                old_job_mtime = f.readline().rstrip()
+        except FileNotFoundError:
+            os.makedirs(self.exapath, exist_ok = True)
+
+        # status only depends on which marker files are in the job directory,
+        # and creating a file bumps the directory's mtime. If that hasn't
+        # moved since last time, neither has the status.
+        job_mtime = os.stat(self.path).st_mtime_ns
+        self.new_job_mtime = None
+        if old_job_mtime == str(job_mtime):
+            self.status = self.old_status
         else:
-            try:
-                with open(self.status_path, 'r') as f:
-                    self.old_status = f.readline().rstrip()
-            except FileNotFoundError:
-                with open(self.status_path, 'a') as f:
-                    f.write('Pending')
-                self.old_status = 'Pending'
-
-        self.check_status()
-        self.write_status(self.status)
+            self.check_status()
+            # not written until save_status, once the job has been processed
+            # and announced, so a job that fails either gets another go
+            self.new_job_mtime = job_mtime if mtime_settled(job_mtime) else ''
 
         emoji = {
             'Running': '🏃',
@@ -241,18 +499,8 @@ class RelionJob(object):
             'Pending': '⌚'
         }
 
-        greetings = [
-            'How are you?',
-            'Hope you\'re well.',
-            "How's it going?",
-            "How's research?",
-            "When are you going to graduate? Haha, anyway.",
-            "Lookin' good!",
-            "Are you drinking water?",
-            "Have a snack after this!"
-        ]
-
-        self.message = f'Hi! {choice(greetings)}\nJob {self.number} in project {self.project} on {gethostname()} has '
+        self.greeting = f'Hi! {choice(GREETINGS)}'
+        self.message = f'Job {self.number} in project {self.project} on {gethostname()} has '
         if self.status == 'Finished':
             self.message += 'finished ✔️.'
         else:
@@ -260,73 +508,135 @@ class RelionJob(object):
 
     def check_status(self):
         status = 'Pending'
+        # one directory listing instead of a stat per marker file
+        with os.scandir(self.path) as entries:
+            job_files = {x.name for x in entries}
+
         # RELION writes a series of files during a job's lifetime. I've decided
         # their heirarchy somewhat manually here.
-        if os.path.exists(os.path.join(self.path, 'run.out')):
+        if 'run.out' in job_files:
             status = 'Running'
-        if os.path.exists(os.path.join(self.path, 'RELION_JOB_EXIT_FAILURE')):
+        if 'RELION_JOB_EXIT_FAILURE' in job_files:
             status = 'Failed'
-        if os.path.exists(os.path.join(self.path, 'RELION_JOB_EXIT_ABORTED')):
+        if 'RELION_JOB_EXIT_ABORTED' in job_files:
             status = 'User Abort'
-        if os.path.exists(os.path.join(self.path, 'RELION_JOB_EXIT_SUCCESS')):
+        if 'RELION_JOB_EXIT_SUCCESS' in job_files:
             status = 'Finished'
 
         self.status = status
 
-    def write_status(self, new_status):
-        with open(self.status_path, 'w') as f:
-            f.write(new_status)
+    def write_status(self, new_status, job_mtime = ''):
+        atomic_write(self.status_path, f'{new_status}\n{job_mtime}')
+
+    def save_status(self):
+        if self.new_job_mtime is not None:
+            self.write_status(self.status, self.new_job_mtime)
+            self.new_job_mtime = None
 
     def announce(self):
         result = self.slack_client.chat_postMessage(
             channel = self.slack_dm,
-            text = self.message
+            text = f'{self.greeting}\n{self.message}'
         )
-        for filename in self.files:
-            self.slack_client.files_upload(
-                channels = self.slack_dm,
-                file = filename,
+        if not self.files:
+            return
+
+        if hasattr(self.slack_client, 'files_upload_v2'):
+            # all the files go up as one share in the thread. This needs the
+            # DM's conversation ID rather than the user ID we post to.
+            self.slack_client.files_upload_v2(
+                channel = result['channel'],
                 thread_ts = result['ts'],
-                filetype = 'png'
+                file_uploads = [{'file': x, 'filename': os.path.basename(x)} for x in self.files],
+                # otherwise it looks every file up afterwards, which needs the
+                # files:read scope on top of the chat:write and files:write
+                # the README asks for
+                request_file_info = False
             )
+        else:
+            for filename in self.files:
+                self.slack_client.files_upload(
+                    channels = self.slack_dm,
+                    file = filename,
+                    thread_ts = result['ts'],
+                    filetype = 'png'
+                )
 
     def make_fsc_curve(self):
+        # model.star goes general, classes, then one block per class. We
+        # only want the first class, so don't parse the rest of the file
         fsc_data = starfile.read(os.path.join(
             self.path,
             'run_model.star'
-        ))['model_class_1']
-
-        fig = plt.figure()
-        plt.axhline(y = 0.143, color = '#AFAFAF', linestyle = '-', zorder = 1)
-        plt.plot(fsc_data.rlnResolution, fsc_data.rlnGoldStandardFsc, '-', zorder = 200)
-        plt.xlabel('Resolution (A)')
-        plt.ylabel('GSFSC')
-        positions = fsc_data.rlnResolution[3::10]
-        labels = [round(float(x), 1) for x in fsc_data.rlnAngstromResolution[3::10]]
-        plt.xticks(positions, labels)
-        plt.grid(color = '#EEEEEE')
+        ), read_n_blocks = 3)['model_class_1']
+        resolution = fsc_data.rlnResolution.to_numpy()
+        angstrom_resolution = fsc_data.rlnAngstromResolution.to_numpy()
+
+        fig = Figure()
+        ax = fig.subplots()
+        ax.axhline(y = 0.143, color = '#AFAFAF', linestyle = '-', zorder = 1)
+        ax.plot(resolution, fsc_data.rlnGoldStandardFsc.to_numpy(), '-', zorder = 200)
+        ax.set_xlabel('Resolution (A)')
+        ax.set_ylabel('GSFSC')
+        positions = resolution[3::10]
+        labels = np.round(angstrom_resolution[3::10], 1).tolist()
+        ax.set_xticks(positions)
+        ax.set_xticklabels(labels)
+        ax.grid(color = '#EEEEEE')
 
         outpath = os.path.join(self.exapath, 'fsc.png')
-        fig.savefig(outpath)
+        fig.savefig(outpath, pil_kwargs = PNG_OPTIONS)
         self.files.append(outpath)
     
-    def process_map(self, map_filename):
-        with mrcfile.open(map_filename) as f:
+    def map_image_path(self, map_filename):
+        imtype = 'projection' if self.settings.map_process == 'projection' else 'sliced'
+        return os.path.join(
+            self.exapath,
+            os.path.split( map_filename)[1][:-4] + '_' + imtype +'.png'
+        )
+
+    def map_image_current(self, map_filename):
+        # a forced reprocess or a deleted last_status.txt doesn't mean the
+        # map changed, and reading it is by far the slowest thing we do
+        try:
+            return os.stat(self.map_image_path(map_filename)).st_mtime_ns >= os.stat(map_filename).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+    def read_map(self, map_filename):
+        # memory-map rather than read the whole volume, so taking a slice
+        # only pages in the planes we use. Everything we need has to be
+        # pulled out before the map is closed.
+        with mrcfile.mmap(map_filename, mode = 'r') as f:
             mrc = f.data
 
-        if self.settings.map_process == 'projection':
-            x_dim = np.sum(mrc, axis = 0)
-            y_dim = np.sum(mrc, axis = 1)
-            z_dim = np.sum(mrc, axis = 2)
-            imtype = 'projection'
-        elif self.settings.map_process == 'slice':
-            middle_slice = int((mrc.shape[0]-1)/2)
-            x_dim = mrc[middle_slice,:,:]
-            y_dim = mrc[:,middle_slice,:]
-            z_dim = mrc[:,:,middle_slice]
-            imtype = 'sliced'
-
-        fig, (axx, axy, axz) = plt.subplots(
+            if self.settings.map_process == 'projection':
+                x_dim, y_dim, z_dim = project_volume(mrc)
+            elif self.settings.map_process == 'slice':
+                middle_slice = int((mrc.shape[0]-1)/2)
+                x_dim = np.array(mrc[middle_slice,:,:])
+                y_dim = np.array(mrc[:,middle_slice,:])
+                z_dim = np.array(mrc[:,:,middle_slice])
+
+        drop_from_page_cache(map_filename)
+
+        # the image in Slack is only a few hundred pixels across, so average
+        # big maps down rather than have imshow rasterise detail nobody sees
+        factor = max(x_dim.shape + y_dim.shape) // 256
+        if factor > 1:
+            # downscale_local_mean pads with zeros where the size isn't a
+            # multiple of factor, which darkens the last row and column
+            x_dim, y_dim, z_dim = [
+                downscale_local_mean(x[:x.shape[0] // factor * factor, :x.shape[1] // factor * factor], (factor, factor))
+                for x in (x_dim, y_dim, z_dim)
+            ]
+
+        return x_dim, y_dim, z_dim
+
+    def plot_map(self, map_filename, dims):
+        x_dim, y_dim, z_dim = dims
+        fig = Figure()
+        axx, axy, axz = fig.subplots(
             ncols = 3,
             sharey = True
         )
@@ -335,14 +645,47 @@ class RelionJob(object):
         axz.imshow(z_dim)
         fig.tight_layout()
         
-        outfile = os.path.join(
-            self.exapath,
-            os.path.split( map_filename)[1][:-4] + '_' + imtype +'.png'
-        )
-        plt.savefig(outfile, bbox_inches = 'tight')
+        outfile = self.map_image_path(map_filename)
+        fig.savefig(outfile, bbox_inches = 'tight', pil_kwargs = PNG_OPTIONS)
 
         self.files.append(outfile)
 
+    def process_map(self, map_filename):
+        self.process_maps([map_filename])
+
+    def process_maps(self, map_filenames):
+        to_read = [x for x in map_filenames if not self.map_image_current(x)]
+
+        # reading the maps is the slow part and numpy lets go of the GIL
+        # while it sums, so do that for every map at once. matplotlib isn't
+        # thread safe though, so the plots are still made one at a time.
+        dims = {}
+        if to_read:
+            workers = min(len(to_read), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers = workers) as executor:
+                dims = dict(zip(to_read, executor.map(self.read_map, to_read)))
+
+        for map_filename in map_filenames:
+            if map_filename in dims:
+                self.plot_map(map_filename, dims[map_filename])
+            else:
+                self.files.append(self.map_image_path(map_filename))
+
+    def iteration_maps(self):
+        # one listing of the job gives us every iteration that wrote maps
+        # as well as the maps from the last one
+        maps = {}
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                iteration = CLASS_MAP_RE.match(entry.name)
+                if iteration:
+                    maps.setdefault(iteration.group(1), []).append(entry.path)
+
+        # RELION pads iteration numbers to three digits, not to a fixed
+        # width, so sort them as numbers
+        iterations = sorted(maps, key = int)
+        return iterations, sorted(maps[iterations[-1]])
+
     def finished_process(self):
         pass
 
@@ -352,13 +695,10 @@ class JobRefine3D(RelionJob):
         super().__init__(path, project, number, slack_info, settings)
 
     def finished_process(self):
-        relevant_lines = []
-        with open(os.path.join(self.path, 'run.out'), 'r') as f:
-            for line in f:
-                if 'Final resolution' in line:
-                    final_res = re.search('[0-9.]+', line).group(0)
-                    self.message += f'\nFinal resolution: *{final_res}*\nMap at: `{self.path}/run_class001.mrc`'
-                    break
+        line = last_line_containing(os.path.join(self.path, 'run.out'), 'Final resolution')
+        if line:
+            final_res = NUM_RE.search(line).group(0)
+            self.message += f'\nFinal resolution: *{final_res}*\nMap at: `{self.path}/run_class001.mrc`'
 
         self.process_map(f'{self.path}/run_class001.mrc')
         self.make_fsc_curve()
@@ -368,125 +708,108 @@ class JobClass3D(RelionJob):
         super().__init__(path, project, number, slack_info, settings)
 
     def make_class_membership_plot(self, iterations):
-        classes_over_time = None
-
         max_it = iterations[-1]
 
-        for iteration in iterations:
-            star_files = starfile.read(f'{self.path}/run_it{iteration}_model.star')
+        def read_class_distribution(iteration):
+            star_files = starfile.read(f'{self.path}/run_it{iteration}_model.star', read_n_blocks = 2)
             cm = star_files['model_classes']
             cm = cm[['rlnReferenceImage', 'rlnClassDistribution']]
 
             # get the class number and fraction of particles for this iteration
-            cm['rlnReferenceImage'] = cm.rlnReferenceImage.apply(lambda x: re.search('class[0-9]{3}', x).group(0))
+            cm['rlnReferenceImage'] = cm.rlnReferenceImage.str.extract(CLASS_RE, expand = False)
             cm.rename(columns = {'rlnReferenceImage': 'Class','rlnClassDistribution': iteration}, inplace = True)
-            cm = cm.set_index('Class')
+            return cm.set_index('Class')[iteration]
 
-            if classes_over_time is None:
-                classes_over_time = cm
-            else:
-                classes_over_time = classes_over_time.join(cm)
+        # every iteration's model.star has to be parsed and they're all
+        # independent, so read them side by side rather than one after another
+        with ThreadPoolExecutor(max_workers = min(len(iterations), 8)) as executor:
+            class_distributions = list(executor.map(read_class_distribution, iterations))
 
         self.message += f'\nMap location: `{self.path}/run_it{max_it}_class*.mrc`'
 
-        class_memb_table = classes_over_time[iterations[-1]]
+        class_memb_table = class_distributions[-1]
         self.message += f'\nClass Membership (fraction of particles)\n```{str(class_memb_table)}```'
 
-        # sort columns then transpose so that each column is a class
-        classes_over_time = classes_over_time.reindex(sorted(classes_over_time.columns), axis = 1)
-        classes_over_time = classes_over_time.transpose()
-        iteration_nums = [int(x) for x in list(classes_over_time.index)]
-
+        # built in one go, rather than joining each iteration on in turn and
+        # copying the growing table every time. iterations are already sorted,
+        # so this is one row per iteration in order and one column per class.
+        classes_over_time = pd.DataFrame(class_distributions)
+        iteration_nums = [int(x) for x in iterations]
 
-        fig = plt.figure()
-        for rln_class in classes_over_time.columns:
-            plt.plot(iteration_nums, classes_over_time[rln_class], '-o', label = f'Class {rln_class}')
+        fig = Figure()
+        ax = fig.subplots()
+        # one line per column of the table, all drawn in a single call
+        lines = ax.plot(iteration_nums, classes_over_time.to_numpy(), '-o')
 
-        plt.xlabel('Iteration number')
-        plt.ylabel('Percent particle membership')
-        plt.ylim(0, 1)
-        plt.legend(loc = 'upper left')
+        ax.set_xlabel('Iteration number')
+        ax.set_ylabel('Percent particle membership')
+        ax.set_ylim(0, 1)
+        ax.legend(lines, [f'Class {x}' for x in classes_over_time.columns], loc = 'upper left')
 
         outpath = os.path.join(self.exapath, 'classes_over_time.png')
-        fig.savefig(outpath)
+        fig.savefig(outpath, pil_kwargs = PNG_OPTIONS)
         self.files.append(outpath)
 
     def make_particle_stability_plot(self):
-        model_stars = glob.glob(os.path.join(self.path, 'run_it*_data.star'))
-        model_stars.sort()
-
-        def process_star_file(starfile):
-            with open(starfile, 'r') as f:
-                lines = [x.rstrip() for x in f]
-
-            line = lines.pop(0)
-            while line != '_rlnNrOfSignificantSamples #22':
-                line = lines.pop(0)
-
-            line = lines.pop(0)
-            particles = {}
-            linelen = len(line.split())
-            for line in lines:
-                if not line:
-                    continue
-                line = line.split()
-                assert len(line) == linelen, line
-                try:
-                    particle_name = line[0]
-                    particle_class = line[16]
-                    particles[particle_name] = particle_class
-                except IndexError:
-                    continue
+        # names come back sorted, and sorting that again by length (it's a
+        # stable sort) puts run_it1000 after run_it999
+        model_stars = sorted(list_dir(self.path, 'run_it*_data.star'), key = len)
 
-            return particles
+        def read_particle_classes(star_path):
+            particles = starfile.read(star_path)['particles']
+            return particles.set_index('rlnImageName')['rlnClassNumber']
 
-        current_classes = process_star_file(model_stars.pop(0))
+        current_classes = read_particle_classes(model_stars.pop(0))
         current_iter = 0
         iter_movement = {}
         while model_stars:
             current_iter += 1
             prev_classes = current_classes
-            current_classes = process_star_file(model_stars.pop(0))
-            particles_moved = sum(current_classes[particle] != prev_classes.get(particle) for particle in current_classes.keys())
-            proportion_moved = particles_moved/len(list(current_classes.keys()))
+            current_classes = read_particle_classes(model_stars.pop(0))
+            if current_classes.index.equals(prev_classes.index):
+                # RELION keeps particles in the same order between iterations,
+                # so usually we can compare the class columns directly
+                particles_moved = np.count_nonzero(current_classes.to_numpy() != prev_classes.to_numpy())
+            else:
+                # particles that weren't in the last iteration come back as NaN
+                # and so count as having moved
+                particles_moved = (current_classes != prev_classes.reindex(current_classes.index)).sum()
+            proportion_moved = particles_moved/len(current_classes)
             iter_movement[current_iter] = proportion_moved
 
-        fig = plt.figure()
-        plt.plot(list(iter_movement.keys()), list(iter_movement.values()), '-o')
+        fig = Figure()
+        ax = fig.subplots()
+        ax.plot(list(iter_movement.keys()), list(iter_movement.values()), '-o')
 
-        plt.xlabel('Iteration number')
-        plt.ylabel('Proportion of particles changing class')
-        plt.ylim(0, 1)
+        ax.set_xlabel('Iteration number')
+        ax.set_ylabel('Proportion of particles changing class')
+        ax.set_ylim(0, 1)
 
         outpath = os.path.join(self.exapath, 'particle_stability.png')
-        fig.savefig(outpath)
+        fig.savefig(outpath, pil_kwargs = PNG_OPTIONS)
         self.files.append(outpath)
 
     def finished_process(self):
-        mrcs = glob.glob(f'{self.path}/run_it*_class*.mrc')
-        iterations = [re.search('it([0-9]{3})', x).group(1) for x in mrcs]
-        iterations = list(set(iterations))
-        iterations.sort()
-        max_it = iterations[-1]
-        maps_to_project = glob.glob(f'{self.path}/run_it{max_it}_class*.mrc')
+        iterations, maps_to_project = self.iteration_maps()
 
         self.make_class_membership_plot(iterations)
         self.make_particle_stability_plot()
 
-        for vol in maps_to_project:
-            self.process_map(vol)
+        self.process_maps(maps_to_project)
 
 class JobPostProcess(RelionJob):
     def __init__(self, path, project, number, slack_info, settings:Settings):
         super().__init__(path, project, number, slack_info, settings)
 
     def finished_process(self):
-        with open(os.path.join(self.path, 'run.out'), 'r') as f:
-            for line in f:
-                if 'FINAL RESOLUTION' in line:
-                    final_res = re.search('[0-9.]+', line).group(0)
+        line = last_line_containing(os.path.join(self.path, 'run.out'), 'FINAL RESOLUTION')
+        if line:
+            final_res = NUM_RE.search(line).group(0)
+            self.message += f'\nFinal resolution: *{final_res}*'
+        else:
+            logging.warning(f'No final resolution found in {self.path}/run.out')
 
-        self.message += f'\nFinal resolution: *{final_res}*\nMap at: `{self.path}/postprocess.mrc`'
+        self.message += f'\nMap at: `{self.path}/postprocess.mrc`'
 
         self.process_map(os.path.join(self.path, 'postprocess.mrc'))
 
@@ -495,27 +818,23 @@ class JobExtract(RelionJob):
         super().__init__(path, project, number, slack_info, settings)
 
     def finished_process(self):
-        with open(self.location, 'r') as f:
-            for line in f:
-                if "Written out STAR file with" in line:
-                    match = re.search('[0-9]+ particles', line).group(0)
-                    
-        self.message += f'\nExtracted {match}.'
+        line = last_line_containing(os.path.join(self.path, 'run.out'), 'Written out STAR file with')
+        match = PARTICLES_RE.search(line) if line else None
+        if match:
+            self.message += f'\nExtracted {match.group(0)}.'
+        else:
+            logging.warning(f'No particle count found in {self.path}/run.out')
 
 class JobInitialModel(RelionJob):
     def __init__(self, path, project, number, slack_info, settings:Settings):
         super().__init__(path, project, number, slack_info, settings)
 
     def finished_process(self):
-        mrcs = glob.glob(f'{self.path}/run_it*_class*.mrc')
-        iterations = [re.search('it([0-9]{3})', x).group(1) for x in mrcs]
-        iterations = list(set(iterations))
-        iterations.sort()
+        iterations, maps_to_project = self.iteration_maps()
         max_it = iterations[-1]
-        maps_to_project = glob.glob(f'{self.path}/run_it{max_it}_class*.mrc')
         for vol in maps_to_project:
             self.message += f"\nMap location: `{self.path}/run_it{max_it}_class*.mrc`"
-            self.process_map(vol)
+        self.process_maps(maps_to_project)
 
 class JobCtfRefine(RelionJob):
     def __init__(self, path, project, number, slack_info, settings:Settings):
@@ -536,19 +855,18 @@ class JobMultiBody(RelionJob):
             if 'Final reconstructions of each body' in line:
                 words = line.split(' ')
                 map_path = [x for x in words if 'MultiBody' in x][0]
-                map_loc = map_path.split('/')[-1].replace('NNN', '???').replace(',', '')
+                map_loc = map_path.rpartition('/')[2].replace('NNN', '???').replace(',', '')
 
             elif 'Final resolution' in line:
-                self.message += f'\nFinal resolution: {line.split(" ")[-1]}'
+                self.message += f'\nFinal resolution: {line.rpartition(" ")[2]}'
 
             elif 'The first' in line and 'explain' in line and 'variance' in line:
                 self.message += f'\n{line}'
 
-        mrcs = glob.glob(f'{self.path}/{map_loc}')
+        mrcs = list_dir(self.path, map_loc)
         self.message += f"\nMap location: `{self.path}/{map_loc}`"
 
-        for vol in mrcs:
-            self.process_map(vol)
+        self.process_maps(mrcs)
 
 class JobCreateMask(RelionJob):
     def __init__(self, path, project, number, slack_info, settings: Settings):
@@ -559,6 +877,23 @@ class JobCreateMask(RelionJob):
 
 def create_slack_client(slack_key) -> WebClient:
     slack_web_client = WebClient(token=slack_key)
+    # a burst of finished jobs can hit Slack's rate limits. slack_sdk can
+    # wait out the Retry-After itself, the old slackclient can't.
+    try:
+        from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+        slack_web_client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count = 3))
+    except ImportError:
+        pass
+    key_hash = hashlib.sha256(str(slack_key).encode()).hexdigest()
+
+    try:
+        with open(AUTH_CACHE, 'r') as f:
+            cached_hash = f.readline().rstrip()
+        if cached_hash == key_hash and time.time() - os.path.getmtime(AUTH_CACHE) < AUTH_CACHE_TTL:
+            logging.debug('Slack token checked recently, skipping auth_test')
+            return slack_web_client
+    except FileNotFoundError:
+        pass
 
     try:
         slack_web_client.auth_test()
@@ -566,8 +901,125 @@ def create_slack_client(slack_key) -> WebClient:
         logging.error('Slack client creation failed. Check your token')
         sys.exit(2)
 
+    try:
+        os.makedirs(os.path.dirname(AUTH_CACHE), exist_ok = True)
+        with open(AUTH_CACHE, 'w') as f:
+            f.write(key_hash)
+    except OSError:
+        logging.debug('Could not write Slack auth cache')
+
     return slack_web_client
 
+def process_projects(db, process_targets, slack_info, args):
+    for project_name in process_targets:
+        current_processor = Project(
+            project_name,
+            db.db['projects'].get(project_name),
+            slack_info,
+            Settings(db.db.get('settings'))
+        )
+        current_processor.scan_for_jobs(force = args.force_process)
+        if args.no_process:
+            # remember where every job is up to without telling anyone
+            for job in current_processor.usable_jobs.values():
+                job.save_status()
+        else:
+            try:
+                current_processor.process_jobs(force = args.force_process)
+            except SlackApiError as e:
+                # the token was trusted without asking Slack, so make sure
+                # the next run checks it properly
+                if e.response.get('error') in AUTH_ERRORS:
+                    try:
+                        os.remove(AUTH_CACHE)
+                    except FileNotFoundError:
+                        pass
+                raise
+        current_processor.save_status_cache()
+
+
+class ExitMarkerHandler(object):
+    # watchdog only ever calls dispatch(), so there's no need to import it
+    # just to subclass its handler
+    def __init__(self, job_exited):
+        self.job_exited = job_exited
+
+    def dispatch(self, event):
+        if event.event_type == 'created':
+            path = event.src_path
+        elif event.event_type == 'moved':
+            path = event.dest_path
+        else:
+            return
+
+        if os.path.basename(path).startswith('RELION_JOB_EXIT_'):
+            logging.debug(f'Saw {path}')
+            self.job_exited.set()
+
+def watch_projects(db, process_targets, slack_info, args):
+    # keep one interpreter, Slack client and lock for as long as we run,
+    # rather than paying for all of that again on every cron tick
+    job_exited = threading.Event()
+    rescan = args.poll_interval or DAEMON_RESCAN
+    observer = None
+
+    if args.daemon:
+        # RELION marks the end of a job by creating a RELION_JOB_EXIT_* file,
+        # so rather than rescanning on a timer, sleep until one turns up
+        try:
+            from watchdog.observers import Observer
+        except ImportError:
+            logging.error('--daemon needs the watchdog package. Install it, use --poll-interval, or run exawatcher from cron.')
+            sys.exit(2)
+
+        handler = ExitMarkerHandler(job_exited)
+        observer = Observer()
+        for project_name in process_targets:
+            project_dir = db.db['projects'].get(project_name)
+            # only the job type directories we process, same as scan_for_jobs.
+            # Watching the whole project would put a watch on every directory
+            # under Movies/ and the like. Type directories made later still
+            # get picked up by the rescan.
+            for job_type in db.settings.available_jobs:
+                type_dir = os.path.join(project_dir, job_type)
+                if os.path.isdir(type_dir):
+                    observer.schedule(handler, type_dir, recursive = True)
+
+        try:
+            observer.start()
+        except OSError:
+            # usually the inotify watch limit on a project with a lot of jobs.
+            # Polling for changes would mean snapshotting the whole project
+            # over and over, far more work than the rescan below, so just
+            # rely on that.
+            logging.warning(f'Could not set up inotify watches, rescanning every {rescan} seconds instead.')
+            observer.stop()
+            observer = None
+
+    try:
+        while True:
+            try:
+                process_projects(db, process_targets, slack_info, args)
+            except Exception:
+                # one broken job or a Slack hiccup shouldn't stop us for good,
+                # the next pass will try again
+                logging.exception('Processing failed, will try again on the next pass.')
+            # only force the first pass, or we'd announce everything every time
+            args.force_process = False
+            # inotify never hears about files written by other NFS clients,
+            # which is where RELION usually runs, and job starts don't make an
+            # exit file anyway. So look everything over every so often regardless.
+            if job_exited.wait(timeout = rescan):
+                # let RELION finish writing the job before we read it
+                time.sleep(2)
+            job_exited.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
 def main(args) :
     # database work can be done even while a lock file exists.
     db = Database(args.db)
@@ -585,18 +1037,19 @@ def main(args) :
     if args.list_projects:
         print('Current projects:', *list(db.current_projects), sep = '\n  ')
 
-    if args.test_slack:
-        slack_client = create_slack_client(db.slack_key)
-        slack_client.chat_postMessage(channel = db.slack_dm, text = 'Slack client successful.')
-
     if args.set_map_process:
         db.settings.map_process = args.set_map_process
-        db.commit_change()
 
     if args.toggle_job_process:
         for job_type in args.toggle_job_process:
             print(db.settings.toggle_ignore_job(job_type))
-        db.commit_change()
+
+    # all the changes above are in memory only, write them out in one go
+    db.commit_change()
+
+    if args.test_slack:
+        slack_client = create_slack_client(db.slack_key)
+        slack_client.chat_postMessage(channel = db.slack_dm, text = 'Slack client successful.')
 
     if args.clear_lock:
         db.clear_lock()
@@ -607,6 +1060,7 @@ def main(args) :
     # we should only process if another instance of exa_watcher is
     # not currently processing
     db.check_lock()
+    load_processing_modules()
 
     if args.process_all:
         process_targets = db.current_projects
@@ -618,19 +1072,20 @@ def main(args) :
         'dm': db.slack_dm
     }
 
-    for project_name in process_targets:
-        current_processor = Project(
-            project_name,
-            db.db['projects'].get(project_name),
-            slack_info,
-            Settings(db.db.get('settings'))
-        )
-        current_processor.scan_for_jobs()
-        if not args.no_process:
-            current_processor.process_jobs(force = args.force_process)
+    if args.daemon or args.poll_interval:
+        watch_projects(db, process_targets, slack_info, args)
+    else:
+        process_projects(db, process_targets, slack_info, args)
 
     db.close_db()
 
+def positive_int(value):
+    # 0 would quietly mean a single run and a negative wait doesn't wait at all
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f'must be a positive number of seconds, not {value}')
+    return number
+
 parser = argparse.ArgumentParser(
     description='Check for changes in slurm jobs. Requires custom sacct output (see README).'
 )
@@ -664,7 +1119,7 @@ database.add_argument(
 )
 database.add_argument(
     '--clear-lock',
-    help = 'Delete lock file. Do this if you had an error and need to process again.',
+    help = 'No longer needed, the lock is released automatically when exawatcher exits.',
     action = 'store_true'
 )
 
@@ -707,6 +1162,16 @@ process.add_argument(
     help = 'Process the given projects even if they already have been. Note that right now this forces reprocessing of all jobs in a project. Might be easier to delete the .exawatcher/last_status.txt file.',
     action = 'store_true'
 )
+process.add_argument(
+    '--daemon',
+    help = 'Keep running and process as soon as a RELION job finishes, rather than waiting for cron. Needs the watchdog package. Projects are also rescanned every 10 minutes, since jobs written from other machines over NFS may not be noticed straight away.',
+    action = 'store_true'
+)
+process.add_argument(
+    '--poll-interval',
+    help = 'Keep running and process every this many seconds, rather than being started by cron. Works on any filesystem and needs no extra packages. With --daemon, sets how often to rescan.',
+    type = positive_int
+)
 process.add_argument(
     '--no-process',
     help = 'Ignore other process arguments, do not process anything. Useful when adding a large project for the first time.',